@@ -12,140 +12,270 @@ Those requirements can be installed with:
 
 """
 import argparse
+from concurrent.futures import (
+    ProcessPoolExecutor, ThreadPoolExecutor, as_completed)
+import contextlib
+import hashlib
+import os
 from pathlib import Path
 
-from sphinx.cmd.build import build_main
-
-
-parser = argparse.ArgumentParser(
-    description=__doc__,
-    usage='%(prog)s [OPTIONS] [THEME-NAMES] [-- SPHINX-OPTIONS]',
-    formatter_class=argparse.RawDescriptionHelpFormatter)
-parser.add_argument(
-    '-l', '--list-themes', action='store_true',
-    help='show list of available themes and exit')
-parser.add_argument(
-    '-r', '--requirements', action='store_true',
-    help='create theme_requirements.txt and exit')
-parser.add_argument(
-    '-f', '--fetch', action='store_true',
-    help='fetch latest data from "upstream"')
-parser.add_argument(
-    'themes', metavar='THEME-NAMES', nargs=argparse.REMAINDER,
-    help='theme names (according to "*-theme" branch names)')
-args = parser.parse_args()
-
-try:
-    import git
-except ImportError as e:
-    parser.exit(
-        'The Python package GitPython has to be installed:\n\n'
-        '    python3 -m pip install GitPython\n')
 
 main_dir = Path(__file__).resolve().parent / 'theme_comparison'
-main_dir.mkdir(exist_ok=True)
-repo = git.Repo(main_dir, search_parent_directories=True)
-for remote in repo.remotes:
-    if any('spatialaudio/nbsphinx' in url for url in remote.urls):
-        if args.fetch:
-            remote.fetch()
-        break
-else:
-    if args.fetch:
-        remote = repo.create_remote(
-            'upstream',
-            'https://github.com/spatialaudio/nbsphinx.git')
-        remote.fetch()
+cache_dir = main_dir / '_cache'
+
+
+def build_docs(name, doc_dir, jobs, sphinx_options):
+    # Importing Sphinx is expensive and only needed for actual builds,
+    # not for the --list-themes/--requirements/--fetch invocations.
+    from sphinx.cmd.build import build_main
+
+    # The builds run concurrently, so each one logs to its own file
+    # instead of interleaving on (and serializing through) the tty.
+    log_path = main_dir / (name + '.log')
+    with open(log_path, 'w', buffering=1) as log_file, \
+            contextlib.redirect_stdout(log_file), \
+            contextlib.redirect_stderr(log_file):
+        result = build_main([
+            str(doc_dir),
+            str(main_dir / name),
+            '-d', str(cache_dir / name),
+            '-j', jobs,
+            '--keep-going',
+            '-Drelease=dummy',
+            '-Dversion=dummy',
+            '-Dtoday=dummy',
+            '-Dhtml_title=nbsphinx-theme-comparison',
+            *sphinx_options,
+        ])
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        usage='%(prog)s [OPTIONS] [THEME-NAMES] [-- SPHINX-OPTIONS]',
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '-l', '--list-themes', action='store_true',
+        help='show list of available themes and exit')
+    parser.add_argument(
+        '-r', '--requirements', action='store_true',
+        help='create theme_requirements.txt and exit')
+    parser.add_argument(
+        '-f', '--fetch', action='store_true',
+        help='fetch latest data from "upstream"')
+    parser.add_argument(
+        '-q', '--quiet', action='store_true',
+        help='run Sphinx in quiet mode (only warnings and errors)')
+    parser.add_argument(
+        '-j', '--jobs', metavar='N', default='auto',
+        help='run Sphinx with N parallel processes, '
+             '"auto" uses all CPU cores (default: %(default)s), '
+             'use 1 if a theme is not parallel-read/write-safe')
+    parser.add_argument(
+        'themes', metavar='THEME-NAMES', nargs=argparse.REMAINDER,
+        help='theme names (according to "*-theme" branch names)')
+    args = parser.parse_args()
+
+    try:
+        import git
+    except ImportError as e:
+        parser.exit(
+            'The Python package GitPython has to be installed:\n\n'
+            '    python3 -m pip install GitPython\n')
+
+    main_dir.mkdir(exist_ok=True)
+    repo = git.Repo(main_dir, search_parent_directories=True)
+    # Only the "*-theme" branches are needed, fetching the rest of the
+    # remote refs would be wasted bandwidth.
+    theme_refspec = '+refs/heads/*-theme:refs/remotes/{}/*-theme'
+    for remote in repo.remotes:
+        if any('spatialaudio/nbsphinx' in url for url in remote.urls):
+            if args.fetch:
+                remote.fetch(theme_refspec.format(remote.name))
+            break
     else:
-        parser.error('no upstream remote found, use --fetch to download')
-
-available_themes = (
-    (ref.remote_head[:-len('-theme')], ref.name)
-    for ref in remote.refs
-    if ref.remote_head.endswith('-theme')
-)
-
-if args.list_themes:
-    for theme, _ in available_themes:
-        print(theme)
-    parser.exit(0)
-
-try:
-    end_of_args = args.themes.index('--')
-except ValueError:
-    end_of_args = len(args.themes)
-requested_themes = args.themes[:end_of_args]
-sphinx_options = args.themes[end_of_args + 1:]
-
-if requested_themes:
-    selected_themes = []
-    for theme, branch in available_themes:
-        if theme in requested_themes:
-            selected_themes.append((theme, branch))
-            requested_themes.remove(theme)
+        if args.fetch:
+            remote = repo.create_remote(
+                'upstream',
+                'https://github.com/spatialaudio/nbsphinx.git')
+            remote.fetch(theme_refspec.format(remote.name))
+        else:
+            parser.error('no upstream remote found, use --fetch to download')
+
+    # A single "git for-each-ref" call is much faster than iterating
+    # remote.refs, which creates a GitPython object per ref.
+    ref_prefix = f'refs/remotes/{remote.name}/'
+    available_themes = [
+        (ref[len(ref_prefix):-len('-theme')], ref[len('refs/remotes/'):])
+        for ref in repo.git.for_each_ref(
+            '--format=%(refname)', ref_prefix + '*-theme').splitlines()
+    ]
+
+    if args.list_themes:
+        for theme, _ in available_themes:
+            print(theme)
+        parser.exit(0)
+
+    try:
+        end_of_args = args.themes.index('--')
+    except ValueError:
+        end_of_args = len(args.themes)
+    requested_themes = args.themes[:end_of_args]
+    sphinx_options = args.themes[end_of_args + 1:]
+    if args.quiet:
+        sphinx_options.insert(0, '-q')
+
     if requested_themes:
-        parser.error(f'theme(s) not found: {requested_themes}')
-else:
-    selected_themes = available_themes
+        theme_branches = dict(available_themes)
+        invalid_themes = [
+            theme for theme in requested_themes
+            if theme not in theme_branches]
+        if invalid_themes:
+            parser.error(f'theme(s) not found: {invalid_themes}')
+        selected_themes = [
+            (theme, theme_branches[theme])
+            for theme in dict.fromkeys(requested_themes)]
+    else:
+        selected_themes = available_themes
+
+    if args.requirements:
+        out_path = main_dir / 'theme_requirements.txt'
+        root_path = Path(repo.working_tree_dir) / 'doc' / 'requirements.txt'
+        branches = [branch for _, branch in selected_themes]
+        # The result only depends on the theme branch tips and the root
+        # requirements.  A fingerprint comment in the file itself allows
+        # skipping the diff loop when none of them changed.
+        shas = repo.git.rev_parse(*branches).splitlines() if branches else []
+        fingerprint = '# fingerprint: ' + hashlib.sha1('|'.join(
+            ['%s:%s' % pair for pair in zip(branches, shas)]
+            + [root_path.read_text()]).encode()).hexdigest()
+        if (out_path.exists()
+                and out_path.read_text().split('\n', 1)[0] == fingerprint):
+            print('Requirements are up to date in', out_path)
+            parser.exit(0)
+        # Each theme branch consists of a single commit, so the
+        # requirements it adds can be read off one "git diff" per branch
+        # instead of cherry-picking every branch into a worktree.
+        # The git calls are subprocess-bound, so threads are enough to
+        # run them concurrently.
+        def requirements_diff(branch):
+            # -U0 drops the context lines (only "+" lines are used) and
+            # --no-color keeps a color.diff=always setting from breaking
+            # the prefix matching below.
+            return repo.git.diff(
+                '-U0', '--no-color', branch + '~..' + branch,
+                '--', 'doc/requirements.txt')
+
+        requirements = set()
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            diffs = executor.map(
+                requirements_diff, [branch for _, branch in selected_themes])
+        for diff in diffs:
+            requirements.update(
+                line[1:] for line in diff.splitlines()
+                if line.startswith('+') and not line.startswith('+++'))
+        requirements.difference_update(root_path.read_text().splitlines())
+        out_path.write_text('\n'.join([fingerprint, *sorted(requirements)]))
+        print('Requirements written to', out_path)
+        parser.exit(0)
+
+    worktree_dir = main_dir / '_worktree'
+    if not worktree_dir.exists():
+        repo.git.worktree('prune')
+        repo.git.worktree('add', worktree_dir, '--detach')
 
-worktree_dir = main_dir / '_worktree'
-if not worktree_dir.exists():
-    repo.git.worktree('prune')
-    repo.git.worktree('add', worktree_dir, '--detach')
+    worktree = git.Git(worktree_dir)
+    head_commit = repo.git.rev_parse('HEAD')
+    worktree.reset(head_commit, '--hard')
+    stash_commit = repo.git.stash('create', '--include-untracked')
+    if stash_commit:
+        worktree.merge(stash_commit)
+    base_commit = worktree.rev_parse('HEAD')
 
-worktree = git.Git(worktree_dir)
-head_commit = repo.git.rev_parse('HEAD')
-worktree.reset(head_commit, '--hard')
-stash_commit = repo.git.stash('create', '--include-untracked')
-if stash_commit:
-    worktree.merge(stash_commit)
-base_commit = worktree.rev_parse('HEAD')
+    # The builds are independent of each other (each one writes to its own
+    # output directory), so each theme branch gets its own worktree and
+    # the Sphinx builds run concurrently in a pool of worker processes.
+    base_tree = worktree.rev_parse('HEAD^{tree}')
+    branches = [branch for _, branch in selected_themes]
+    branch_tips = dict(zip(
+        branches,
+        repo.git.rev_parse(*branches).splitlines() if branches else []))
+    to_build = []
+    stamps = {}
 
+    def prepare_worktree(branch, theme_worktree_dir):
+        theme_worktree = git.Git(theme_worktree_dir)
+        theme_worktree.reset(base_commit, '--hard')
+        theme_worktree.cherry_pick(branch)
 
-def run_with_all_themes(func):
     try:
         for name, branch in selected_themes:
-            worktree.cherry_pick(branch)
-            func(name, branch)
-            worktree.reset(base_commit, '--hard')
+            # A build only depends on the (stash-merged) base tree, the
+            # theme commit and the Sphinx invocation; if none of those
+            # changed since the last successful build, skip it entirely.
+            stamp_path = cache_dir / (name + '.stamp')
+            stamp = '\n'.join([
+                base_tree, branch_tips[branch], args.jobs,
+                *sphinx_options])
+            if ('-a' not in sphinx_options
+                    and (main_dir / name).exists()
+                    and stamp_path.exists()
+                    and stamp_path.read_text() == stamp):
+                print(name, 'is up to date, skipping (pass "-- -a" to force)')
+                continue
+            stamp_path.unlink(missing_ok=True)
+            stamps[name] = stamp_path, stamp
+            # The worktrees are kept between runs: "git reset --hard"
+            # only rewrites files whose content changed, which preserves
+            # the mtimes Sphinx uses to decide what to rebuild.
+            theme_worktree_dir = main_dir / ('_worktree-' + name)
+            if not theme_worktree_dir.exists():
+                repo.git.worktree('prune')
+                repo.git.worktree('add', theme_worktree_dir, '--detach')
+            to_build.append((name, branch, theme_worktree_dir))
+        if to_build:
+            max_workers = min(len(to_build), os.cpu_count() or 1)
+            # The worktrees are brought up to date in a thread pool (the
+            # git subprocesses run concurrently) and each build is
+            # submitted as soon as its worktree is ready, so git work
+            # overlaps with the first Sphinx builds.
+            with ThreadPoolExecutor(max_workers=8) as git_executor, \
+                    ProcessPoolExecutor(max_workers=max_workers) as executor:
+                preparations = {
+                    git_executor.submit(
+                        prepare_worktree, branch, theme_worktree_dir):
+                            (name, theme_worktree_dir)
+                    for name, branch, theme_worktree_dir in to_build}
+                futures = []
+                for preparation in as_completed(preparations):
+                    name, theme_worktree_dir = preparations[preparation]
+                    preparation.result()
+                    futures.append((name, executor.submit(
+                        build_docs,
+                        name,
+                        theme_worktree_dir / 'doc',
+                        args.jobs,
+                        sphinx_options)))
+                # The builds are independent, so a failed theme doesn't
+                # abort the others; all failures are reported at the end.
+                failed_themes = []
+                for name, future in futures:
+                    result = future.result()
+                    log_path = main_dir / (name + '.log')
+                    if result != 0:
+                        print(name, 'failed, see', log_path)
+                        failed_themes.append(name)
+                        continue
+                    print(name, 'done, log in', log_path)
+                    stamp_path, stamp = stamps[name]
+                    stamp_path.write_text(stamp)
+            if failed_themes:
+                parser.exit(1, f'theme build(s) failed: {failed_themes}\n')
     finally:
         worktree.reset(head_commit, '--hard')
         repo.git.worktree('prune')
 
 
-if args.requirements:
-    requirements = set()
-
-    def collect_requirements(name, branch):
-        path = worktree_dir / 'doc' / 'requirements.txt'
-        requirements.update(path.read_text().splitlines())
-
-    run_with_all_themes(collect_requirements)
-    path = Path(repo.working_tree_dir) / 'doc' / 'requirements.txt'
-    requirements.difference_update(path.read_text().splitlines())
-    path = main_dir / 'theme_requirements.txt'
-    path.write_text('\n'.join(sorted(requirements)))
-    print('Requirements written to', path)
-    parser.exit(0)
-
-
-def build_docs(name, branch):
-    print('#' * 80)
-    print('#', name.upper().center(76), '#')
-    print('#' * 80)
-    result = build_main([
-        str(worktree_dir / 'doc'),
-        str(main_dir / name),
-        '-d', str(main_dir / '_cache'),
-        '-Drelease=dummy',
-        '-Dversion=dummy',
-        '-Dtoday=dummy',
-        '-Dhtml_title=nbsphinx-theme-comparison',
-        *sphinx_options,
-    ])
-    if result != 0:
-        parser.exit(result)
-    print('')
-
-
-run_with_all_themes(build_docs)
+if __name__ == '__main__':
+    main()